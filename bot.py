@@ -1,8 +1,12 @@
 # bot.py
 import discord
 from discord import app_commands # Required for slash commands
-import os
-import requests
+from os import getenv
+import re
+import sys
+import aiohttp
+import asyncio
+import orjson
 import logging
 from dotenv import load_dotenv
 
@@ -12,8 +16,9 @@ logger = logging.getLogger(__name__)
 
 # --- Load Environment Variables ---
 load_dotenv() # Load .env file for local development
-DISCORD_BOT_TOKEN = os.getenv('DISCORD_BOT_TOKEN')
-N8N_WEBHOOK_BASE_URL = os.getenv('N8N_WEBHOOK_BASE_URL')
+DISCORD_BOT_TOKEN = getenv('DISCORD_BOT_TOKEN')
+N8N_WEBHOOK_BASE_URL = getenv('N8N_WEBHOOK_BASE_URL')
+DEV_GUILD_ID = getenv('DEV_GUILD_ID') # Optional: sync commands to this guild only (dev/staging)
 
 if not DISCORD_BOT_TOKEN:
     logger.error("FATAL: DISCORD_BOT_TOKEN environment variable not set.")
@@ -21,31 +26,134 @@ if not DISCORD_BOT_TOKEN:
 if not N8N_WEBHOOK_BASE_URL:
     logger.error("FATAL: N8N_WEBHOOK_BASE_URL environment variable not set.")
     exit()
+if DEV_GUILD_ID and not DEV_GUILD_ID.isdigit():
+    logger.error("FATAL: DEV_GUILD_ID must be a numeric Discord guild ID.")
+    exit()
+
+# The base URL never changes at runtime, so build the webhook prefix once
+_WEBHOOK_PREFIX = f"{N8N_WEBHOOK_BASE_URL.rstrip('/')}/webhook-waiting/"
+
+# Payloads are pre-serialized with orjson, so the content type is set explicitly
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+# --- User-Facing Messages ---
+# Fixed-shape replies are built once; the bound .format methods fill in the execution ID
+_SUCCESS_MSG = "✅ Successfully sent metadata for execution `{}` to the workflow!".format
+_ERR_BASE = "❌ Failed to send metadata to the workflow for execution `{}`.".format
+_ERR_STATUS_TAIL = "\n_Details: Received status {} from n8n._".format
+_ERR_404_TAIL = "\n_(This often means the execution ID is incorrect or the workflow is no longer waiting.)_"
+_ERR_CONN_TAIL = "\n_(Could not connect to the n8n instance.)_"
+_ERR_METADATA = "❌ Invalid metadata format. Please use format 'speaker_00:name,speaker_01:name'"
+_ERR_INVALID_ID = "❌ Invalid ID format. IDs may only contain letters, numbers, '_' and '-'."
+_ERR_UNEXPECTED = "❌ An unexpected error occurred. Please check the bot logs."
+
+# --- Input Validation ---
+# Execution and transcription IDs are interpolated into the webhook URL and payload
+_ID_RE = re.compile(r'[A-Za-z0-9_-]{1,64}')
 
 # --- Discord Bot Setup ---
+# Sync target for guild-scoped command registration, built once rather than on every on_ready
+_DEV_GUILD = discord.Object(id=int(DEV_GUILD_ID)) if DEV_GUILD_ID else None
+
 # Define intents - default is usually fine for slash commands
 intents = discord.Intents.default()
 # intents.message_content = True # Only needed if using prefix commands or reading message text
 
+# Shared HTTP session for n8n calls, created in setup_hook so its connection pool
+# (and the TCP+TLS handshakes it holds) is reused across commands
+http_session: aiohttp.ClientSession | None = None
+
 # Use Client for simpler setup, or Bot for more features (like cogs)
-# Using Client here as it's sufficient
-client = discord.Client(intents=intents)
+# Using Client here as it's sufficient; subclassed only to manage the HTTP session's lifetime
+class WitnessClient(discord.Client):
+    async def setup_hook(self):
+        """Create the shared n8n HTTP session before the gateway connects."""
+        # Interactions are dispatched as soon as they arrive, before on_ready fires,
+        # so the session has to exist before the bot can receive any command
+        global http_session
+        http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=100, limit_per_host=20, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=10) # 10 second timeout
+        )
+
+    async def close(self):
+        """Close the shared n8n HTTP session before disconnecting from Discord."""
+        if http_session is not None and not http_session.closed:
+            await http_session.close()
+        await super().close()
+
+client = WitnessClient(intents=intents)
 # Command Tree stores the slash command definitions
 tree = app_commands.CommandTree(client)
 
+# --- n8n Requests ---
+# POSTs currently in flight, keyed by (webhook URL, serialized body). A duplicate
+# submission for the same execution joins the pending request instead of sending another.
+_inflight_posts: dict[tuple[str, bytes], asyncio.Task] = {}
+
+# Most bytes of an n8n error response body that are read for logging
+_ERROR_BODY_LIMIT = 2048
+
+# Delay before the single retry of a POST whose connection could not be established
+_CONNECT_RETRY_DELAY = 0.5 # seconds
+
+async def _post_to_n8n(webhook_url: str, body: bytes) -> int:
+    """POST to n8n, retrying once if no connection could be made to the host."""
+    try:
+        return await _send_post(webhook_url, body)
+    except aiohttp.ClientConnectorError as e:
+        # The request never reached n8n, so resending can't resume the workflow twice.
+        # Anything that may have been delivered is not retried.
+        logger.warning("Could not connect to n8n (%s); retrying in %ss", e, _CONNECT_RETRY_DELAY)
+        await asyncio.sleep(_CONNECT_RETRY_DELAY)
+        return await _send_post(webhook_url, body)
+
+async def _send_post(webhook_url: str, body: bytes) -> int:
+    """POST a serialized payload to an n8n webhook and return the response status."""
+    async with http_session.post(webhook_url, data=body, headers=_JSON_HEADERS) as response:
+        status = response.status
+        if status >= 400:
+            # The body is only readable while the response is open, so log it here.
+            # Read a bounded prefix; error pages can be large and only the start is useful.
+            body_prefix = await response.content.read(_ERROR_BODY_LIMIT)
+            logger.error("n8n response body: %s", body_prefix.decode(errors='replace'))
+            response.raise_for_status() # Raise ClientResponseError for bad status codes (4xx or 5xx)
+        return status
+
+async def _post_coalesced(webhook_url: str, body: bytes) -> int:
+    """POST to n8n, sharing the result of an identical request that is already in flight."""
+    key = (webhook_url, body)
+    task = _inflight_posts.get(key)
+    if task is None:
+        task = asyncio.create_task(_post_to_n8n(webhook_url, body))
+        _inflight_posts[key] = task
+        task.add_done_callback(lambda _: _inflight_posts.pop(key, None))
+    # Shield so one caller being cancelled doesn't cancel the request for the others
+    return await asyncio.shield(task)
+
 # --- Bot Events ---
 @client.event
 async def on_ready():
     """Event handler for when the bot connects to Discord."""
-    logger.info(f'Logged in as {client.user.name} (ID: {client.user.id})')
+    logger.info('Logged in as %s (ID: %s)', client.user.name, client.user.id)
     logger.info('Syncing command tree...')
     try:
-        # Sync commands globally. Can take up to an hour to propagate.
-        # For testing, sync to a specific guild: await tree.sync(guild=discord.Object(id=YOUR_GUILD_ID))
-        synced = await tree.sync()
-        logger.info(f"Synced {len(synced)} command(s).")
+        if _DEV_GUILD is not None:
+            # Guild-scoped sync is a single request and takes effect immediately
+            tree.copy_global_to(guild=_DEV_GUILD)
+            synced = await tree.sync(guild=_DEV_GUILD)
+        else:
+            # Sync commands globally. Can take up to an hour to propagate.
+            synced = await tree.sync()
+        logger.info("Synced %d command(s).", len(synced))
     except Exception as e:
-        logger.error(f"Failed to sync command tree: {e}")
+        logger.error("Failed to sync command tree: %s", e)
+    # Open a pooled connection to n8n now so the first command doesn't pay for the TCP+TLS handshake
+    try:
+        async with http_session.head(N8N_WEBHOOK_BASE_URL, timeout=aiohttp.ClientTimeout(total=5)):
+            pass
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.warning("n8n warm-up failed: %s", e)
     logger.info('Bot is ready and listening!')
 
 # --- Bot Commands ---
@@ -57,22 +165,36 @@ async def on_ready():
 )
 async def attribute_speakers(interaction: discord.Interaction, execution_id: str, metadata: str, transcription_id: str):
     """Slash command handler to send data to n8n."""
-    logger.info(f"Received /attribute-speakers from {interaction.user} for execution ID: {execution_id}")
-
-    # Parse the metadata string into a dictionary
-    speaker_map = {}
-    try:
-        pairs = metadata.split(',')
-        for pair in pairs:
-            speaker_id, speaker_name = pair.strip().split(':')
-            speaker_map[speaker_id] = speaker_name
-    except ValueError as e:
-        logger.error(f"Error parsing metadata string: {e}")
-        await interaction.response.send_message("❌ Invalid metadata format. Please use format 'speaker_00:name,speaker_01:name'", ephemeral=True)
+    logger.info("Received /attribute-speakers from %s for execution ID: %s", interaction.user, execution_id)
+    # These checks are instant, so reply directly instead of paying for a defer + followup round trip.
+    # Malformed IDs would only ever 404 (or hit another path) on n8n, so never send them.
+    if not _ID_RE.fullmatch(execution_id) or not _ID_RE.fullmatch(transcription_id):
+        logger.error("Invalid ID format: execution_id=%r transcription_id=%r", execution_id, transcription_id)
+        await interaction.response.send_message(_ERR_INVALID_ID, ephemeral=True)
+        return
+    # Metadata without a single ':' can never be valid
+    if ':' not in metadata:
+        logger.error("Error parsing metadata string: %r", metadata)
+        await interaction.response.send_message(_ERR_METADATA, ephemeral=True)
         return
+    # Defer before doing any work so the 3-second interaction ack deadline is always met;
+    # every reply after this point goes through the followup webhook
+    await interaction.response.defer(ephemeral=True) # Ephemeral: only visible to the user
 
-    webhook_url = f"{N8N_WEBHOOK_BASE_URL.rstrip('/')}/webhook-waiting/{execution_id}"
-    logger.info(f"Target n8n webhook URL: {webhook_url}")
+    # Parse the metadata string into a dictionary.
+    # partition always returns a 3-tuple, so a pair without ':' shows up as an empty separator
+    speaker_map = {}
+    for pair in metadata.split(','):
+        speaker_id, sep, speaker_name = pair.partition(':')
+        speaker_id = speaker_id.strip()
+        if not sep or not speaker_id:
+            logger.error("Error parsing metadata string: %r", metadata)
+            await interaction.followup.send(_ERR_METADATA, ephemeral=True)
+            return
+        speaker_map[speaker_id] = speaker_name.strip()
+
+    webhook_url = _WEBHOOK_PREFIX + execution_id
+    logger.info("Target n8n webhook URL: %s", webhook_url)
 
     # Updated payload to include parsed speaker map
     payload = {
@@ -82,38 +204,47 @@ async def attribute_speakers(interaction: discord.Interaction, execution_id: str
 
     # Make the POST request to n8n
     try:
-        # Defer the response first, as the request might take time
-        await interaction.response.defer(ephemeral=True) # Ephemeral: only visible to the user
-
-        logger.info(f"Sending POST request to n8n with payload: {payload}")
-        response = requests.post(webhook_url, json=payload, timeout=10) # 10 second timeout
-        response.raise_for_status() # Raise an exception for bad status codes (4xx or 5xx)
-
-        logger.info(f"n8n workflow {execution_id} successfully triggered. Status: {response.status_code}")
-        await interaction.followup.send(f"✅ Successfully sent metadata for execution `{execution_id}` to the workflow!", ephemeral=True)
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error sending request to n8n for execution {execution_id}: {e}")
-        error_message = f"❌ Failed to send metadata to the workflow for execution `{execution_id}`."
-        if e.response is not None:
-            logger.error(f"n8n response status: {e.response.status_code}")
-            logger.error(f"n8n response body: {e.response.text}")
-            error_message += f"\n_Details: Received status {e.response.status_code} from n8n._"
-            if e.response.status_code == 404:
-                 error_message += "\n_(This often means the execution ID is incorrect or the workflow is no longer waiting.)_"
-        else:
-             error_message += "\n_(Could not connect to the n8n instance.)_"
+        logger.info("Sending POST request to n8n with payload: %s", payload)
+        status = await _post_coalesced(webhook_url, orjson.dumps(payload))
+
+        logger.info("n8n workflow %s successfully triggered. Status: %s", execution_id, status)
+        await interaction.followup.send(_SUCCESS_MSG(execution_id), ephemeral=True)
+    except aiohttp.ClientResponseError as e:
+        logger.error("Error sending request to n8n for execution %s: %s", execution_id, e)
+        logger.error("n8n response status: %s", e.status)
+        error_message = _ERR_BASE(execution_id) + _ERR_STATUS_TAIL(e.status)
+        if e.status == 404:
+             error_message += _ERR_404_TAIL
+        await interaction.followup.send(error_message, ephemeral=True)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error("Error sending request to n8n for execution %s: %s", execution_id, e)
+        error_message = _ERR_BASE(execution_id) + _ERR_CONN_TAIL
         await interaction.followup.send(error_message, ephemeral=True)
 
     except Exception as e:
-        logger.exception(f"An unexpected error occurred processing /provide-metadata for {execution_id}: {e}")
-        await interaction.followup.send(f"❌ An unexpected error occurred. Please check the bot logs.", ephemeral=True)
+        logger.exception("An unexpected error occurred processing /attribute-speakers for %s: %s", execution_id, e)
+        await interaction.followup.send(_ERR_UNEXPECTED, ephemeral=True)
 
 
 # --- Run the Bot ---
+async def main():
+    """Log in and run the bot until it is closed (what client.run does internally)."""
+    async with client: # Runs client.close on exit, which also closes the HTTP session
+        await client.start(DISCORD_BOT_TOKEN) # Logging is the basicConfig set up above
+
 if __name__ == "__main__":
     try:
-        client.run(DISCORD_BOT_TOKEN, log_handler=None) # Use default logging configured above
+        if sys.platform != 'win32':
+            # uvloop is a faster drop-in replacement for the asyncio event loop (POSIX only).
+            # uvloop.run passes a uvloop loop factory to asyncio.Runner rather than relying
+            # on the event loop policy API, which is deprecated in newer Python versions.
+            import uvloop
+            uvloop.run(main())
+        else:
+            asyncio.run(main())
+    except KeyboardInterrupt:
+        pass # Ctrl+C is a normal shutdown, as with client.run
     except discord.LoginFailure:
         logger.error("FATAL: Invalid Discord Bot Token. Please check your .env file or environment variables.")
     except Exception as e:
-        logger.exception(f"FATAL: Bot failed to run: {e}")
\ No newline at end of file
+        logger.exception("FATAL: Bot failed to run: %s", e)
\ No newline at end of file
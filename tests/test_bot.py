@@ -1,20 +1,22 @@
 # test_bot.py
 
+import asyncio
 import pytest
 import pytest_asyncio # Implicitly used by pytest.mark.asyncio
-from unittest.mock import AsyncMock, MagicMock, patch # Use AsyncMock for awaitables
-import requests
-import os
+from unittest.mock import AsyncMock, MagicMock # Use AsyncMock for awaitables
+import aiohttp
+import orjson
 
 # Import the command object from your bot code and alias it for clarity
 # Assuming your bot file is named bot.py
 from bot import attribute_speakers as attribute_speakers_command
+import bot
 
 # --- Fixtures ---
 
-@pytest.fixture
-def mock_interaction(mocker):
-    """Fixture to create a mock discord.Interaction object."""
+@pytest.fixture(scope="module")
+def mock_interaction():
+    """Fixture to create a mock discord.Interaction object, built once and shared by the module."""
     # Create a base mock for the interaction
     mock_interaction = MagicMock() # Use MagicMock to allow arbitrary attribute access
 
@@ -34,6 +36,31 @@ def mock_interaction(mocker):
 
     return mock_interaction
 
+@pytest.fixture(autouse=True)
+def reset_interaction(mock_interaction):
+    """Fixture to clear the shared mock_interaction's call history before each test."""
+    # reset_mock recurses into the attached response/followup AsyncMocks, clearing their awaits too
+    mock_interaction.reset_mock()
+
+def make_mock_response(status, text=""):
+    """Build a mock aiohttp response with the given status code and body."""
+    mock_response = MagicMock(status=status)
+    mock_response.content.read = AsyncMock(return_value=text.encode())
+    if status >= 400:
+        # Make raise_for_status raise an appropriate error when called
+        mock_response.raise_for_status.side_effect = aiohttp.ClientResponseError(
+            request_info=MagicMock(), history=(), status=status
+        )
+    return mock_response
+
+@pytest.fixture
+def mock_http_session(mocker):
+    """Fixture to replace the bot's shared aiohttp session with a mock."""
+    mock_session = mocker.patch('bot.http_session')
+    # session.post(...) is used as an async context manager; MagicMock supports __aenter__/__aexit__
+    mock_session.post.return_value.__aenter__.return_value = make_mock_response(200)
+    return mock_session
+
 @pytest.fixture(autouse=True)
 def mock_env_vars(monkeypatch):
     """Fixture to set mock environment variables for tests."""
@@ -44,7 +71,7 @@ def mock_env_vars(monkeypatch):
 # --- Test Cases ---
 
 @pytest.mark.asyncio
-async def test_attribute_speakers_success(mock_interaction, mocker):
+async def test_attribute_speakers_success(mock_interaction, mock_http_session):
     """Test the command with valid input and a successful webhook call."""
     # Arrange
     execution_id = "exec_123"
@@ -55,8 +82,8 @@ async def test_attribute_speakers_success(mock_interaction, mocker):
         "metadata": {"speaker_00": "Alice", "speaker_01": "Bob"},
         "transcription_id": transcription_id
     }
-    # Mock requests.post to return a successful response
-    mock_post = mocker.patch('requests.post', return_value=MagicMock(status_code=200, raise_for_status=lambda: None))
+    # The mock session returns a successful response by default
+    mock_post = mock_http_session.post
 
     # Act --- Call the function's CALLBACK under test ---
     await attribute_speakers_command.callback(mock_interaction, execution_id, metadata_str, transcription_id)
@@ -64,11 +91,11 @@ async def test_attribute_speakers_success(mock_interaction, mocker):
     # Assert ---
     # 1. Check if defer was called
     mock_interaction.response.defer.assert_awaited_once_with(ephemeral=True)
-    # 2. Check if requests.post was called correctly
+    # 2. Check if http_session.post was called correctly
     mock_post.assert_called_once_with(
         expected_webhook_url,
-        json=expected_payload,
-        timeout=10
+        data=orjson.dumps(expected_payload),
+        headers={"Content-Type": "application/json"}
     )
     # 3. Check if the success message was sent via followup
     mock_interaction.followup.send.assert_awaited_once_with(
@@ -80,33 +107,82 @@ async def test_attribute_speakers_success(mock_interaction, mocker):
 
 
 @pytest.mark.asyncio
-async def test_attribute_speakers_invalid_metadata_format(mock_interaction, mocker):
+async def test_attribute_speakers_invalid_metadata_format(mock_interaction, mock_http_session):
     """Test the command with improperly formatted metadata."""
     # Arrange
     execution_id = "exec_456"
     invalid_metadata_str = "speaker_00:Alice, speaker_01Bob" # Missing colon
     transcription_id = "trans_def"
-    # Mock requests.post just in case, although it shouldn't be called
-    mock_post = mocker.patch('requests.post')
+    # Mock http_session.post just in case, although it shouldn't be called
+    mock_post = mock_http_session.post
+
+    # Act --- Call the function's CALLBACK under test ---
+    await attribute_speakers_command.callback(mock_interaction, execution_id, invalid_metadata_str, transcription_id)
+
+    # Assert ---
+    # 1. Check defer was called before the metadata was rejected
+    mock_interaction.response.defer.assert_awaited_once_with(ephemeral=True)
+    # 2. Check if the specific error message was sent via followup
+    mock_interaction.followup.send.assert_awaited_once_with(
+        "❌ Invalid metadata format. Please use format 'speaker_00:name,speaker_01:name'",
+        ephemeral=True
+    )
+    mock_interaction.response.send_message.assert_not_awaited()
+    # 3. Ensure http_session.post was NOT called
+    mock_post.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_attribute_speakers_metadata_without_separator(mock_interaction, mock_http_session):
+    """Test that metadata with no ':' at all is rejected immediately, without deferring."""
+    # Arrange
+    execution_id = "exec_457"
+    invalid_metadata_str = "Alice, Bob" # No speaker IDs at all
+    transcription_id = "trans_def"
 
     # Act --- Call the function's CALLBACK under test ---
     await attribute_speakers_command.callback(mock_interaction, execution_id, invalid_metadata_str, transcription_id)
 
     # Assert ---
-    # 1. Check if the specific error message was sent via response.send_message
+    # 1. Check the error message was sent as the direct response
     mock_interaction.response.send_message.assert_awaited_once_with(
         "❌ Invalid metadata format. Please use format 'speaker_00:name,speaker_01:name'",
         ephemeral=True
     )
-    # 2. Ensure defer and followup were NOT called
+    # 2. Ensure defer, followup and http_session.post were NOT called
     mock_interaction.response.defer.assert_not_awaited()
     mock_interaction.followup.send.assert_not_awaited()
-    # 3. Ensure requests.post was NOT called
-    mock_post.assert_not_called()
+    mock_http_session.post.assert_not_called()
 
 
 @pytest.mark.asyncio
-async def test_attribute_speakers_webhook_404_error(mock_interaction, mocker):
+@pytest.mark.parametrize("execution_id, transcription_id", [
+    ("../admin", "trans_def"), # Execution ID would escape the webhook-waiting path
+    ("exec_456", "a b"), # Invalid character in the transcription ID
+    ("e" * 65, "trans_def"), # One character over the length limit
+])
+async def test_attribute_speakers_invalid_ids(mock_interaction, mock_http_session, execution_id, transcription_id):
+    """Test that malformed execution or transcription IDs are rejected before any network I/O."""
+    # Arrange
+    metadata_str = "speaker_00:Alice"
+
+    # Act --- Call the function's CALLBACK under test ---
+    await attribute_speakers_command.callback(mock_interaction, execution_id, metadata_str, transcription_id)
+
+    # Assert ---
+    # 1. Check the error message was sent as the direct response
+    mock_interaction.response.send_message.assert_awaited_once_with(
+        "❌ Invalid ID format. IDs may only contain letters, numbers, '_' and '-'.",
+        ephemeral=True
+    )
+    # 2. Ensure defer, followup and http_session.post were NOT called
+    mock_interaction.response.defer.assert_not_awaited()
+    mock_interaction.followup.send.assert_not_awaited()
+    mock_http_session.post.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_attribute_speakers_webhook_404_error(mock_interaction, mock_http_session):
     """Test the command when the webhook returns a 404 Not Found."""
     # Arrange
     execution_id = "exec_789"
@@ -114,10 +190,9 @@ async def test_attribute_speakers_webhook_404_error(mock_interaction, mocker):
     transcription_id = "trans_ghi"
     expected_webhook_url = f"http://test-n8n-instance.com/webhook-waiting/{execution_id}"
     # Configure the mock response for 404
-    mock_response = MagicMock(status_code=404, text="Execution not found or already completed")
-    # Make raise_for_status raise an appropriate error when called
-    mock_response.raise_for_status.side_effect = requests.exceptions.HTTPError(response=mock_response)
-    mock_post = mocker.patch('requests.post', return_value=mock_response)
+    mock_response = make_mock_response(404, text="Execution not found or already completed")
+    mock_post = mock_http_session.post
+    mock_post.return_value.__aenter__.return_value = mock_response
 
     # Act --- Call the function's CALLBACK under test ---
     await attribute_speakers_command.callback(mock_interaction, execution_id, metadata_str, transcription_id)
@@ -125,7 +200,7 @@ async def test_attribute_speakers_webhook_404_error(mock_interaction, mocker):
     # Assert ---
     # 1. Check defer was called
     mock_interaction.response.defer.assert_awaited_once_with(ephemeral=True)
-    # 2. Check requests.post was called
+    # 2. Check http_session.post was called
     mock_post.assert_called_once() # Args already checked in success test, focus on outcome
     # 3. Check if the specific 404 error message was sent via followup
     expected_error_msg_part1 = f"❌ Failed to send metadata to the workflow for execution `{execution_id}`."
@@ -142,14 +217,15 @@ async def test_attribute_speakers_webhook_404_error(mock_interaction, mocker):
 
 
 @pytest.mark.asyncio
-async def test_attribute_speakers_webhook_connection_error(mock_interaction, mocker):
-    """Test the command when requests.post fails to connect."""
+async def test_attribute_speakers_webhook_connection_error(mock_interaction, mock_http_session):
+    """Test the command when http_session.post fails to connect."""
     # Arrange
     execution_id = "exec_101"
     metadata_str = "speaker_03:David"
     transcription_id = "trans_jkl"
     # Configure mock_post to raise a ConnectionError
-    mock_post = mocker.patch('requests.post', side_effect=requests.exceptions.ConnectionError("Failed to establish connection"))
+    mock_post = mock_http_session.post
+    mock_post.side_effect = aiohttp.ClientConnectionError("Failed to establish connection")
 
     # Act --- Call the function's CALLBACK under test ---
     await attribute_speakers_command.callback(mock_interaction, execution_id, metadata_str, transcription_id)
@@ -157,7 +233,7 @@ async def test_attribute_speakers_webhook_connection_error(mock_interaction, moc
     # Assert ---
     # 1. Check defer was called
     mock_interaction.response.defer.assert_awaited_once_with(ephemeral=True)
-    # 2. Check requests.post was called
+    # 2. Check http_session.post was called
     mock_post.assert_called_once()
     # 3. Check if the specific connection error message was sent via followup
     expected_error_msg_part1 = f"❌ Failed to send metadata to the workflow for execution `{execution_id}`."
@@ -170,14 +246,39 @@ async def test_attribute_speakers_webhook_connection_error(mock_interaction, moc
 
 
 @pytest.mark.asyncio
-async def test_attribute_speakers_unexpected_error(mock_interaction, mocker):
+async def test_attribute_speakers_retries_failed_connection(mock_interaction, mock_http_session, monkeypatch):
+    """Test that a POST whose connection could not be established is retried once."""
+    # Arrange
+    execution_id = "exec_102"
+    metadata_str = "speaker_03:David"
+    transcription_id = "trans_jkl"
+    monkeypatch.setattr("bot._CONNECT_RETRY_DELAY", 0) # Don't actually wait between attempts
+    # First attempt fails to connect, second returns the default successful response
+    mock_post = mock_http_session.post
+    connect_error = aiohttp.ClientConnectorError(MagicMock(), OSError("Connection refused"))
+    mock_post.side_effect = [connect_error, mock_post.return_value]
+
+    # Act --- Call the function's CALLBACK under test ---
+    await attribute_speakers_command.callback(mock_interaction, execution_id, metadata_str, transcription_id)
+
+    # Assert ---
+    # 1. Check the POST was attempted twice
+    assert mock_post.call_count == 2
+    # 2. Check the success message was sent via followup
+    mock_interaction.followup.send.assert_awaited_once_with(
+        f"✅ Successfully sent metadata for execution `{execution_id}` to the workflow!",
+        ephemeral=True
+    )
+
+@pytest.mark.asyncio
+async def test_attribute_speakers_unexpected_error(mock_interaction, mock_http_session):
     """Test handling of an unexpected error during processing."""
     # Arrange
     execution_id = "exec_err"
     metadata_str = "speaker_04:Eve"
     transcription_id = "trans_mno"
-    # Mock requests.post to cause an unexpected error *after* defer()
-    mocker.patch('requests.post', side_effect=ValueError("Something weird happened")) # Simulate unexpected error
+    # Mock http_session.post to cause an unexpected error *after* defer()
+    mock_http_session.post.side_effect = ValueError("Something weird happened") # Simulate unexpected error
 
     # Act --- Call the function's CALLBACK under test ---
     await attribute_speakers_command.callback(mock_interaction, execution_id, metadata_str, transcription_id)
@@ -189,4 +290,46 @@ async def test_attribute_speakers_unexpected_error(mock_interaction, mocker):
     mock_interaction.followup.send.assert_awaited_once_with(
         f"❌ An unexpected error occurred. Please check the bot logs.",
         ephemeral=True
-    )
\ No newline at end of file
+    )
+
+
+@pytest.mark.asyncio
+async def test_attribute_speakers_coalesces_duplicate_submissions(mock_interaction, mock_http_session):
+    """Test that identical submissions in flight at the same time share a single webhook call."""
+    # Arrange
+    execution_id = "exec_dup"
+    metadata_str = "speaker_00:Alice"
+    transcription_id = "trans_dup"
+
+    # Act --- Submit the same command twice concurrently ---
+    await asyncio.gather(
+        attribute_speakers_command.callback(mock_interaction, execution_id, metadata_str, transcription_id),
+        attribute_speakers_command.callback(mock_interaction, execution_id, metadata_str, transcription_id),
+    )
+
+    # Assert ---
+    # 1. Check only one POST reached n8n
+    mock_http_session.post.assert_called_once()
+    # 2. Check both invocations got the success message
+    assert mock_interaction.followup.send.await_count == 2
+    mock_interaction.followup.send.assert_awaited_with(
+        f"✅ Successfully sent metadata for execution `{execution_id}` to the workflow!",
+        ephemeral=True
+    )
+
+
+@pytest.mark.asyncio
+async def test_setup_hook_creates_http_session(monkeypatch):
+    """Test that the shared HTTP session exists before the gateway connects (and so before any command)."""
+    # Arrange
+    monkeypatch.setattr("bot.http_session", None)
+
+    # Act
+    await bot.client.setup_hook()
+
+    # Assert ---
+    try:
+        assert isinstance(bot.http_session, aiohttp.ClientSession)
+        assert not bot.http_session.closed
+    finally:
+        await bot.http_session.close()